@@ -1,15 +1,17 @@
-import html2text
+from lxml import html as lxml_html
 
 
-h = html2text.HTML2Text()
-
-# Ignore converting links from HTML
-h.ignore_links = True
-
 with open('test/134132_eng/134132_eng_processed.html', 'r') as file:
     html_data = file.read()
 
-text_data = h.handle(html_data)
+# One line of text per innermost div, which is how pdf2htmlEX lays out text lines
+# A PDF without text pages cleans down to a bare head, which lxml parses without a body
+body = lxml_html.document_fromstring(html_data).find("body")
+if body is None:
+    text_data = ""
+else:
+    lines = (" ".join(div.text_content().split()) for div in body.xpath(".//div[not(descendant::div)]"))
+    text_data = "\n".join(line for line in lines if line)
 
 with open('text_from_html.txt', 'w') as file:
     file.write(text_data)
@@ -17,5 +19,3 @@ with open('text_from_html.txt', 'w') as file:
 
 
 print(text_data)
-
-
@@ -1,24 +1,23 @@
+import argparse
+from pathlib import Path
+
 import pdftotext
 
+parser = argparse.ArgumentParser(description="Extract the text of a PDF with pdftotext.")
+parser.add_argument("--verbose", action="store_true", help="Also print the extracted text.")
+args = parser.parse_args()
+
 # Load your PDF
 with open("test/134132_eng.pdf", "rb") as f:
     pdf = pdftotext.PDF(f, physical=True)
 
-
-# How many pages?
-print(len(pdf))
-
-# Iterate over all the pages
-for page in pdf:
-    print(page)
-
-# Read some individual pages
-print(pdf[0])
-print(pdf[1])
-
 # Read all the text into one string
-print("\n\n".join(pdf))
+text = "\n\n".join(pdf)
+
+if args.verbose:
+    # How many pages?
+    print(len(pdf))
+    print(text)
 
 # Save the PDF text to a file
-with open("test/134132_eng.txt", "w") as text_file:
-    text_file.write("\n\n".join(pdf))
+Path("test/134132_eng.txt").write_text(text)
@@ -24,21 +24,188 @@
 
 # Author: Fabio Espinosa, fabio.espinosa(at)dfki.de
 
+import asyncio
+import hashlib
 import subprocess
+import sys
+import tempfile
 import time
-from bs4 import BeautifulSoup, NavigableString
-from openai import OpenAI
+from bs4 import BeautifulSoup
+import httpx
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
 import json
+import re
 import tiktoken
 import os
-from typing import Tuple, List, Optional, NoReturn
-import html2text
+from typing import Dict, Iterable, Iterator, Tuple, List, Optional, NoReturn
+from lxml import etree
+from lxml import html as lxml_html
 import yaml
+import diskcache
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The model's YAML is untrusted input, so only the safe loader is used; libyaml's C version when built.
+try:
+    from yaml import CSafeDumper as _YamlDumper, CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeDumper as _YamlDumper, SafeLoader as _YamlLoader
+
+
+# System prompts are kept as constants so the prefix of every request is byte-identical,
+# which lets the API serve it from its prompt cache.
+HTML_TO_JSON_PROMPT = "Good morning, you are a helpful assistant and an expert web developer. Some  in a pdf file were converted into the HTML code that's inside triple backticks. Please turn that code into several JSON structures that represent the original tables. Try to recognize and exclude headers and footers from the structures. Only return the JSON structures, no additional commentary or content."
+TEXT_TO_JSON_PROMPT = "Good morning, you are a helpful assistant and an expert web developer. Some tables were converted into HTML code and then into the text that's inside triple backticks. Please turn that text into several JSON structures that represent the original tables.Try to recognize and exclude headers and footers from the structures. Only return the JSON structures, no additional commentary or content."
+HTML_TO_YAML_PROMPT = "Good morning, you are a helpful assistant and an expert web developer. Some tables were converted into the HTML code that's inside triple backticks. Please turn that code into several valid YAML structures that represent the original tables. Make yure the YAML structures are valid with no invalid chracters inside the values or the keys. Try to recognize and exclude headers and footers from the structures. Only return the YAML structures, no additional commentary or content."
+TEXT_TO_YAML_PROMPT = "Good morning, you are a helpful assistant and an expert web developer. Some tables were converted into HTML code and then into the text that's inside triple backticks. Please turn that text into several valid YAML structures that represent the original tables. Make yure the YAML structures are valid with no invalid chracters inside the values or the keys. Try to recognize and exclude headers and footers from the structures. Only return the YAML structures, no additional commentary or content."
+
+# pdf2htmlEX options. Everything except the text layer is either skipped or written to
+# separate files, which keeps the HTML we parse and send to the model small.
+PDF2HTMLEX_OPTIONS = [
+    "--font-size-multiplier", "1",
+    "--zoom", "25",
+    "--process-nontext", "0",
+    "--process-outline", "0",
+    "--embed-css", "0",
+    "--embed-font", "0",
+    "--embed-image", "0",
+    "--embed-javascript", "0",
+    "--embed-outline", "0",
+    "--split-pages", "0",
+    "--optimize-text", "1",
+    "--tounicode", "1",
+    "--no-drm", "1",
+]
+
+# Rough number of characters per token, used where an exact tiktoken count is not worth its cost.
+CHARS_PER_TOKEN = 4
+
+# Concurrency and retry policy of run_inference_batch.
+MAX_CONCURRENT_REQUESTS = 10
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+
+# Seconds between status checks of a submitted batch.
+BATCH_POLL_INTERVAL = 60.0
+
+# Directory of the persistent cache of model responses.
+LLM_CACHE_DIRECTORY = os.path.join(".cache", "llm")
+
+# Parent of the scratch directories pdf2htmlEX writes into. The raw HTML is read back right
+# away and deleted, so a RAM-backed tmpfs is used where the system has one.
+PDF2HTMLEX_SCRATCH_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Number of characters of pdf2htmlEX output fed to the HTML parser at a time. Each page is
+# cleaned and freed as soon as it has been parsed, so memory holds about one page, not the document.
+HTML_FEED_CHARS = 1 << 16
+
+# Whitespace characters that Python's str.strip() removes but XPath's normalize-space() keeps,
+# such as the non-breaking spaces pdf2htmlEX emits. They are mapped to spaces before testing.
+_UNICODE_SPACES = (
+    "\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a"
+    "\u2028\u2029\u202f\u205f\u3000"
+)
+_TEXT_WITHOUT_UNICODE_SPACES = f"translate(., '{_UNICODE_SPACES}', '{' ' * len(_UNICODE_SPACES)}')"
+
+# XPath queries of clean_html_content: inside a page, the images and the divs and spans that
+# hold no text, which are all removed.
+_EMPTY_ELEMENTS = etree.XPath(
+    f".//img | .//div[not(normalize-space({_TEXT_WITHOUT_UNICODE_SPACES}))]"
+    f" | .//span[not(normalize-space({_TEXT_WITHOUT_UNICODE_SPACES}))]"
+)
+_CLASSED_DIVS = etree.XPath(".//div[@class]")
+_NORMALIZED_TEXT = etree.XPath(f"normalize-space({_TEXT_WITHOUT_UNICODE_SPACES})")
+
+# Markdown code fence the model sometimes wraps around its JSON answer.
+_JSON_FENCE_RE = re.compile(r"\A\s*```(?:json)?\s*|\s*```\s*\Z")
+
+# Divs without nested divs, i.e. the text lines of a pdf2htmlEX page.
+_LEAF_DIVS = etree.XPath(".//div[not(descendant::div)]")
+
+# Markdown code fences the model puts around its YAML answer, and the table turning brackets
+# into quotes before the YAML is parsed.
+_YAML_FENCE_RE = re.compile(r"```(?:yaml)?")
+_BRACKETS_TO_QUOTES = str.maketrans("[]", '""')
+
+# Responses longer than this are validated but not re-indented before they are saved, so a
+# multi-megabyte table dump is never serialized a second time just for formatting.
+JSON_REFORMAT_MAX_CHARS = 1 << 20
+
+# Streamed responses are echoed to stdout once this many characters or seconds have accumulated.
+STREAM_FLUSH_BYTES = 8192
+STREAM_FLUSH_SECONDS = 0.025
+
+
+def _loads_json(data):
+    """
+    Parses a JSON document, with orjson when it is installed and the standard library otherwise.
+
+    Raises:
+    - json.JSONDecodeError: If the data is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps_json(obj, indent: bool = False) -> bytes:
+    """
+    Serializes an object to UTF-8 encoded JSON, with orjson when it is installed and the standard
+    library otherwise. Non-string keys, which YAML allows, are converted to strings.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode()
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_identifier: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding for a model, loading its BPE tables only once per process.
+
+    Raises:
+    - KeyError: If the model_identifier does not correspond to any known model encoding.
+    """
+    return tiktoken.encoding_for_model(model_identifier)
+
+
+@lru_cache(maxsize=None)
+def _get_client(api_endpoint: Optional[str]) -> OpenAI:
+    """
+    Returns the OpenAI client for an endpoint, creating it on first use.
+
+    Clients are shared per process so their HTTP/2 connection pool stays warm across
+    requests instead of paying a new TCP and TLS handshake on every call.
+
+    Parameters:
+    - api_endpoint (Optional[str]): The host of a local model server, or None for the OpenAI API.
+    """
+    return OpenAI(
+        base_url=f"http://{api_endpoint}/v1" if api_endpoint else None,
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60),
+        ),
+    )
+
 
 class PdfToJsonPipeline:
-    def __init__(self, model_identifier: str, api_endpoint: Optional[str] = None):
+    def __init__(
+        self,
+        model_identifier: str,
+        api_endpoint: Optional[str] = None,
+        cache_directory: str = LLM_CACHE_DIRECTORY,
+    ):
         self.model_identifier = model_identifier
         self.api_endpoint = api_endpoint
+        self.response_cache = diskcache.Cache(cache_directory)
+        # Token counts by content digest, so re-counting the same page or document is free
+        self._token_counts: Dict[bytes, int] = {}
 
     def calculate_token_count(self, text: str) -> int:
         """
@@ -51,111 +218,170 @@ class PdfToJsonPipeline:
         Returns:
         - int: The number of tokens in the encoded text.
 
+        Raises:
+        - ValueError: If the model_identifier does not correspond to any known model encoding.
+        """
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        token_count = self._token_counts.get(digest)
+        if token_count is None:
+            # Special tokens are only meaningful in prompts we build ourselves, never in PDF text
+            token_count = len(self._get_model_encoding().encode_ordinary(text))
+            self._token_counts[digest] = token_count
+        return token_count
+
+    def _get_model_encoding(self) -> tiktoken.Encoding:
+        """
+        Helper function that returns the tiktoken encoding of the pipeline's model.
+
         Raises:
         - ValueError: If the model_identifier does not correspond to any known model encoding.
         """
         try:
-            encoding = tiktoken.encoding_for_model(self.model_identifier)
+            return _get_encoding(self.model_identifier)
         except KeyError:
             raise ValueError(f"Unknown model identifier: {self.model_identifier}")
-        return len(encoding.encode(text))
 
-    def convert_pdf_to_html(self, pdf_file_path: str, output_directory: str) -> None:
+    def estimate_token_count(self, text: str) -> int:
         """
-        Converts a PDF file to HTML format, saving the output in a specified directory.
+        Estimates the number of tokens in a text without running the tokenizer.
+
+        Parameters:
+        - text (str): The input text.
+
+        Returns:
+        - int: The approximate token count, assuming CHARS_PER_TOKEN characters per token.
+        """
+        return len(text) // CHARS_PER_TOKEN
+
+    def convert_pdf_to_html(self, pdf_file_path: str) -> str:
+        """
+        Converts a PDF file to HTML format and returns the HTML content.
+
+        pdf2htmlEX writes into a temporary directory that is removed as soon as the
+        HTML has been read back, so nothing is left on disk.
 
         Parameters:
         - pdf_file_path (str): The file path of the PDF to convert.
-        - output_directory (str): The directory where the HTML file will be saved.
+
+        Returns:
+        - str: The HTML produced by pdf2htmlEX.
 
         Raises:
         - FileNotFoundError: If the specified PDF file does not exist.
         - subprocess.CalledProcessError: If the pdf2htmlEX command fails.
+        - IOError: If the generated HTML file cannot be read.
         """
         if not os.path.exists(pdf_file_path):
             raise FileNotFoundError(
                 f"The specified PDF file does not exist: {pdf_file_path}"
             )
 
-        command = f"pdf2htmlEX '{pdf_file_path}' --dest-dir '{output_directory}' --font-size-multiplier 1 --zoom 25"
-        try:
-            subprocess.run(command, shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            raise Exception(f"Failed to convert PDF to HTML: {e}")
+        with tempfile.TemporaryDirectory(dir=PDF2HTMLEX_SCRATCH_DIRECTORY) as output_directory:
+            command = [
+                "pdf2htmlEX",
+                pdf_file_path,
+                "--dest-dir",
+                output_directory,
+                *PDF2HTMLEX_OPTIONS,
+            ]
+            try:
+                subprocess.run(
+                    command,
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                )
+            except subprocess.CalledProcessError as e:
+                raise Exception(f"Failed to convert PDF to HTML: {e}\n{e.stderr}")
+
+            html_file_name = os.path.splitext(os.path.basename(pdf_file_path))[0] + ".html"
+            html_file_path = os.path.join(output_directory, html_file_name)
+            try:
+                with open(html_file_path, "r") as file:
+                    return file.read()
+            except IOError as e:
+                raise IOError(f"Failed to read HTML file at {html_file_path}: {e}")
 
-    def clean_html_content(self, html_file_path: str) -> Tuple[str, List[str]]:
+    def clean_html_content(
+        self, html_content: str, processed_html_path: Optional[str] = None
+    ) -> Tuple[str, List[str]]:
         """
-        Removes images, styles, and non-textual elements from an HTML file,
-        and saves the cleaned content to a new file.
+        Removes images, styles, and non-textual elements from HTML content. The HTML is parsed
+        incrementally and every page is freed once it has been cleaned.
 
         Parameters:
-        - html_file_path (str): The path to the original HTML file.
+        - html_content (str): The HTML produced by pdf2htmlEX.
+        - processed_html_path (Optional[str]): If given, the cleaned HTML is also written to
+        this path for debugging. Defaults to None.
 
         Returns:
         - Tuple[str, List[str]]: A tuple containing the complete cleaned HTML content as a string
-        and a list of cleaned div elements as strings.
+        and a list of the cleaned page divs as strings, in page order.
 
         Raises:
-        - IOError: If the specified HTML file cannot be read or written.
+        - IOError: If the cleaned HTML cannot be written to processed_html_path.
         """
-        try:
-            with open(html_file_path, "r") as file:
-                html_content = file.read()
-        except IOError as e:
-            raise IOError(f"Failed to read HTML file at {html_file_path}: {e}")
-
-        soup = BeautifulSoup(html_content, "html.parser")
-        body = soup.body
-        page_divs = soup.find_all("div", attrs={"data-page-no": True})
-        head = soup.head
-        for element in head.find_all():
-            if element.name != "style":
-                element.decompose()
-        for element in head.find_all():
-            if element.name == "font-face" or 'font-family' in str(element):
-                element.decompose()
-        cleaned_html_body = ""
+        parser = etree.HTMLPullParser(events=("end",), tag=("style", "div"))
+        parser.set_element_class_lookup(lxml_html.HtmlElementClassLookup())
+        styles_as_strings = []
         divs_as_strings = []
-        for div in body:
-            cleaned_div = self._remove_images_and_empty_divs(div)
-            div_as_str = str(cleaned_div)
-            divs_as_strings.append(div_as_str)
-            cleaned_html_body += div_as_str
-
-        cleaned_html_head = str(head)
-        cleaned_html_content = cleaned_html_head + cleaned_html_body
-        processed_html_path = html_file_path.replace(".html", "_processed.html")
-        try:
-            with open(processed_html_path, "w") as file:
-                file.write(cleaned_html_content + "\n")
-        except IOError as e:
-            raise IOError(f"Failed to write cleaned HTML to {processed_html_path}: {e}")
+        for start in range(0, len(html_content), HTML_FEED_CHARS):
+            parser.feed(html_content[start : start + HTML_FEED_CHARS])
+            self._clean_parsed_elements(parser.read_events(), styles_as_strings, divs_as_strings)
+        parser.close()
+        self._clean_parsed_elements(parser.read_events(), styles_as_strings, divs_as_strings)
+
+        cleaned_html_head = "<head>" + "".join(styles_as_strings) + "</head>"
+        cleaned_html_content = cleaned_html_head + "".join(divs_as_strings)
+        if processed_html_path is not None:
+            try:
+                with open(processed_html_path, "w") as file:
+                    file.writelines((cleaned_html_content, "\n"))
+            except IOError as e:
+                raise IOError(f"Failed to write cleaned HTML to {processed_html_path}: {e}")
 
         return cleaned_html_content, divs_as_strings
 
-    def _remove_images_and_empty_divs(self, div_element) -> None:
+    def _clean_parsed_elements(
+        self, events, styles_as_strings: List[str], divs_as_strings: List[str]
+    ) -> None:
         """
-        Helper function to remove image tags and empty divs from a div element.
+        Helper function that cleans the style blocks and page divs the parser has just completed,
+        appends them as strings to the given lists and frees the pages.
 
         Parameters:
-        - div_element (bs4.element.Tag): The BeautifulSoup tag object representing a div element.
+        - events: The (event, element) pairs read from an HTMLPullParser.
+        - styles_as_strings (List[str]): The kept style blocks of the head.
+        - divs_as_strings (List[str]): The cleaned page divs, in page order.
         """
-        for img in div_element.find_all("img"):
-            img.decompose()
-        for div in div_element.find_all("div"):
-           
-            if "class" in div.attrs:
-                del div.attrs["class"]
-            if not div.find_all(string=lambda text: isinstance(text, NavigableString)):
-                div.decompose()
-            if not div.text.strip():
-                div.decompose()
-        for span in div_element.find_all("span"):
-            if not span.text.strip():
-                span.decompose()
-        return div_element
-
-    def html_tables_to_json_llm(self, query: str, model:str, streaming:bool, json_mode:bool) -> str:
+        for _, element in events:
+            if element.tag == "style":
+                # Keep only the style blocks of the head, minus the ones declaring fonts
+                if element.getparent().tag == "head" and "font-family" not in (element.text or ""):
+                    styles_as_strings.append(
+                        etree.tostring(element, encoding="unicode", method="html", with_tail=False)
+                    )
+                continue
+            if element.get("data-page-no") is None:
+                continue
+            # Blank pages are dropped altogether
+            if _NORMALIZED_TEXT(element):
+                for empty_element in _EMPTY_ELEMENTS(element):
+                    # drop_tree keeps the text that follows the element
+                    empty_element.drop_tree()
+                for classed_div in _CLASSED_DIVS(element):
+                    del classed_div.attrib["class"]
+                element.attrib.pop("class", None)
+                divs_as_strings.append(
+                    etree.tostring(element, encoding="unicode", method="html", with_tail=False)
+                )
+            # Free the page and the pages before it; the parser only ever appends after it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def html_tables_to_json_llm(self, query: str, model:str, streaming:bool, json_mode:bool, ignore_cache: bool = False) -> str:
         """
         Executes an inference query using a specified language model, optionally via a local server.
 
@@ -163,6 +389,7 @@ class PdfToJsonPipeline:
         - query (str): The query to send to the model.
         - model_identifier (str): The identifier of the model to use for the inference.
         - api_endpoint (Optional[str]): The base URL for the API, if using a local model server. Defaults to None.
+        - ignore_cache (bool): Skip the on-disk response cache and always query the model. Defaults to False.
 
         Returns:
         - str: The complete response from the model.
@@ -170,30 +397,32 @@ class PdfToJsonPipeline:
         Raises:
         - ValueError: If `api_endpoint` is required but not provided.
         """
-        
-        prompt = "Good morning, you are a helpful assistant and an expert web developer. Some  in a pdf file were converted into the HTML code that's inside triple backticks. Please turn that code into several JSON structures that represent the original tables. Try to recognize and exclude headers and footers from the structures. Only return the JSON structures, no additional commentary or content."
-        response = self.run_inference(query, model, streaming, prompt, json_mode)
+        response = self.run_inference(query, model, streaming, HTML_TO_JSON_PROMPT, json_mode, ignore_cache)
         return response
     
-    def html_to_text(self, html_data) -> str:
+    def html_to_text(self, html_data: str) -> str:
         """
-        Converts a HTML file to text format, saving the output in a specified directory.
+        Converts HTML to plain text, one line per innermost div, which is how pdf2htmlEX
+        lays out the text lines of a page.
 
         Parameters:
-        - html_file_path (str): The file path of the HTML to convert.
+        - html_data (str): The HTML to convert.
 
         Returns:
-        - str: The complete text content of the HTML file.
+        - str: The complete text content of the HTML body, or an empty string if it has none.
         """
-        h = html2text.HTML2Text()
-        # Ignore converting links from HTML
-        h.ignore_links = True
-        
-
-        text_data = h.handle(html_data)
-        return text_data
+        # A PDF without text pages cleans down to a bare head, which lxml parses without a body
+        body = lxml_html.document_fromstring(html_data).find("body")
+        if body is None:
+            return ""
+        lines = []
+        for div in _LEAF_DIVS(body):
+            line = " ".join(div.text_content().split())
+            if line:
+                lines.append(line)
+        return "\n".join(lines)
     
-    def text_tables_to_json_llm(self, query: str, model:str, streaming:bool, json_mode:bool) -> str:
+    def text_tables_to_json_llm(self, query: str, model:str, streaming:bool, json_mode:bool, ignore_cache: bool = False) -> str:
         """
         Executes an inference query using a specified language model, optionally via a local server.
 
@@ -201,6 +430,7 @@ class PdfToJsonPipeline:
         - query (str): The query to send to the model.
         - model_identifier (str): The identifier of the model to use for the inference.
         - api_endpoint (Optional[str]): The base URL for the API, if using a local model server. Defaults to None.
+        - ignore_cache (bool): Skip the on-disk response cache and always query the model. Defaults to False.
 
         Returns:
         - str: The complete response from the model.
@@ -208,12 +438,10 @@ class PdfToJsonPipeline:
         Raises:
         - ValueError: If `api_endpoint` is required but not provided.
         """
-       
-        prompt = "Good morning, you are a helpful assistant and an expert web developer. Some tables were converted into HTML code and then into the text that's inside triple backticks. Please turn that text into several JSON structures that represent the original tables.Try to recognize and exclude headers and footers from the structures. Only return the JSON structures, no additional commentary or content."
-        response = self.run_inference(query, model, streaming, prompt, json_mode)
+        response = self.run_inference(query, model, streaming, TEXT_TO_JSON_PROMPT, json_mode, ignore_cache)
         return response
 
-    def html_tables_to_yaml_llm(self, query: str, model:str, streaming:bool, json_mode:bool) -> str:
+    def html_tables_to_yaml_llm(self, query: str, model:str, streaming:bool, json_mode:bool, ignore_cache: bool = False) -> str:
         """
         Executes an inference query using a specified language model, optionally via a local server.
 
@@ -221,6 +449,7 @@ class PdfToJsonPipeline:
         - query (str): The query to send to the model.
         - model_identifier (str): The identifier of the model to use for the inference.
         - api_endpoint (Optional[str]): The base URL for the API, if using a local model server. Defaults to None.
+        - ignore_cache (bool): Skip the on-disk response cache and always query the model. Defaults to False.
 
         Returns:
         - str: The complete response from the model.
@@ -228,13 +457,11 @@ class PdfToJsonPipeline:
         Raises:
         - ValueError: If `api_endpoint` is required but not provided.
         """
-       
-        prompt = "Good morning, you are a helpful assistant and an expert web developer. Some tables were converted into the HTML code that's inside triple backticks. Please turn that code into several valid YAML structures that represent the original tables. Make yure the YAML structures are valid with no invalid chracters inside the values or the keys. Try to recognize and exclude headers and footers from the structures. Only return the YAML structures, no additional commentary or content."
-        response = self.run_inference(query, model, streaming, prompt, json_mode)
+        response = self.run_inference(query, model, streaming, HTML_TO_YAML_PROMPT, json_mode, ignore_cache)
         return response
 
     
-    def text_tables_to_yaml_llm(self, query: str, model:str, streaming:bool, json_mode:bool) -> str:
+    def text_tables_to_yaml_llm(self, query: str, model:str, streaming:bool, json_mode:bool, ignore_cache: bool = False) -> str:
         """
         Executes an inference query using a specified language model, optionally via a local server.
 
@@ -242,6 +469,7 @@ class PdfToJsonPipeline:
         - query (str): The query to send to the model.
         - model_identifier (str): The identifier of the model to use for the inference.
         - api_endpoint (Optional[str]): The base URL for the API, if using a local model server. Defaults to None.
+        - ignore_cache (bool): Skip the on-disk response cache and always query the model. Defaults to False.
 
         Returns:
         - str: The complete response from the model.
@@ -249,12 +477,10 @@ class PdfToJsonPipeline:
         Raises:
         - ValueError: If `api_endpoint` is required but not provided.
         """
-        
-        prompt = "Good morning, you are a helpful assistant and an expert web developer. Some tables were converted into HTML code and then into the text that's inside triple backticks. Please turn that text into several valid YAML structures that represent the original tables. Make yure the YAML structures are valid with no invalid chracters inside the values or the keys. Try to recognize and exclude headers and footers from the structures. Only return the YAML structures, no additional commentary or content."
-        response = self.run_inference(query, model, streaming, prompt, json_mode)
+        response = self.run_inference(query, model, streaming, TEXT_TO_YAML_PROMPT, json_mode, ignore_cache)
         return response
     
-    def run_inference(self, query: str, model:str, streaming:bool, prompt:str, json_mode:bool) -> str:
+    def run_inference(self, query: str, model:str, streaming:bool, prompt:str, json_mode:bool, ignore_cache: bool = False) -> str:
         """
         Executes an inference query using a specified language model, optionally via a local server.
 
@@ -262,6 +488,7 @@ class PdfToJsonPipeline:
         - query (str): The query to send to the model.
         - model_identifier (str): The identifier of the model to use for the inference.
         - api_endpoint (Optional[str]): The base URL for the API, if using a local model server. Defaults to None.
+        - ignore_cache (bool): Skip the on-disk response cache and always query the model. Defaults to False.
 
         Returns:
         - str: The complete response from the model.
@@ -272,20 +499,298 @@ class PdfToJsonPipeline:
         if model == "local-model" and self.api_endpoint is None:
             raise ValueError("API endpoint must be provided when using a local model.")
 
-        client = OpenAI(
-            base_url=f"http://{self.api_endpoint}/v1" if self.api_endpoint else None
-        )
+        # Identical requests are answered from disk, which skips the network round trip entirely
+        cache_key = self._response_cache_key(query, model, prompt, json_mode)
+        if not ignore_cache:
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                print(f"Using cached response from {model}")
+                return cached_response
+
+        client = _get_client(self.api_endpoint)
 
         print(
-            f"Model client for {model} created. Preparing to send query..."
+            f"Model client for {model} ready. Preparing to send query..."
         )
 
-        token_count = self.calculate_token_count(query)
-        print(f"Number of tokens to send: {token_count}")
+        # The count is only logged, so the exact one, which costs a full BPE pass over the
+        # document, is opt-in. Models tiktoken does not know fall back to the estimate.
+        token_count = None
+        if os.getenv("PDF_PIPELINE_VERBOSE"):
+            try:
+                token_count = self.calculate_token_count(query)
+            except ValueError:
+                pass
+        if token_count is not None:
+            print(f"Number of tokens to send: {token_count}")
+        else:
+            print(f"Approximate number of tokens to send: {self.estimate_token_count(query)}")
 
         print("Sending request...")
-        soup = BeautifulSoup(query, 'html.parser')
-        prettified_html = soup.prettify()
+        request = self._build_request(query, model, prompt, json_mode)
+        if streaming:
+            # Read the raw event stream instead of letting the SDK build a model object per token
+            with client.chat.completions.with_streaming_response.create(
+                stream=True, **request
+            ) as raw_response:
+                complete_response = self._collect_stream(self._iter_stream_deltas(raw_response))
+        else:
+            response = client.chat.completions.create(stream=False, **request)
+            complete_response = response.choices[0].message.content
+            self._log_prompt_cache_usage(response)
+
+        self.response_cache[cache_key] = complete_response
+        return complete_response
+
+    async def run_inference_batch(
+        self,
+        queries: List[str],
+        model: str,
+        prompt: str,
+        json_mode: bool,
+        ignore_cache: bool = False,
+    ) -> List[str]:
+        """
+        Executes several inference queries concurrently with the same model and prompt.
+
+        The requests share one async client and at most MAX_CONCURRENT_REQUESTS of them are in
+        flight at a time. Rate-limit errors, connection errors, timeouts and 5xx responses are
+        retried with exponential backoff.
+        Responses are never streamed: nobody watches them arrive, and a complete response frees
+        its connection for the next request sooner.
+        Identical queries, such as the same boilerplate page in several PDFs, are sent only once.
+
+        This is library API: ProcessPdfs runs its four requests per PDF on threads through
+        run_inference and does not call it. Use it to send many queries with one prompt. Unlike
+        ProcessPdfs, it caches responses before they are validated; callers should use
+        discard_cached_response for answers they reject.
+
+        Parameters:
+        - queries (List[str]): The queries to send to the model.
+        - model (str): The identifier of the model to use for the inference.
+        - prompt (str): The system prompt sent with every query.
+        - json_mode (bool): Whether to request JSON output.
+        - ignore_cache (bool): Skip the on-disk response cache and always query the model. Defaults to False.
+
+        Returns:
+        - List[str]: The complete responses, in the same order as the queries.
+
+        Raises:
+        - ValueError: If `api_endpoint` is required but not provided.
+        """
+        if model == "local-model" and self.api_endpoint is None:
+            raise ValueError("API endpoint must be provided when using a local model.")
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        async with AsyncOpenAI(
+            base_url=f"http://{self.api_endpoint}/v1" if self.api_endpoint else None,
+            # _run_inference_async does its own backoff; SDK retries would multiply the attempts
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS),
+            ),
+        ) as client:
+            unique_queries = list(dict.fromkeys(queries))
+            unique_responses = await asyncio.gather(
+                *[
+                    self._run_inference_async(
+                        client, semaphore, query, model, prompt, json_mode, ignore_cache
+                    )
+                    for query in unique_queries
+                ]
+            )
+        responses_by_query = dict(zip(unique_queries, unique_responses))
+        return [responses_by_query[query] for query in queries]
+
+    async def _run_inference_async(
+        self,
+        client: AsyncOpenAI,
+        semaphore: asyncio.Semaphore,
+        query: str,
+        model: str,
+        prompt: str,
+        json_mode: bool,
+        ignore_cache: bool,
+    ) -> str:
+        """
+        Helper function that executes one query of run_inference_batch.
+
+        Returns:
+        - str: The complete response from the model.
+        """
+        cache_key = self._response_cache_key(query, model, prompt, json_mode)
+        if not ignore_cache:
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+
+        request = self._build_request(query, model, prompt, json_mode)
+        async with semaphore:
+            for attempt in range(MAX_RETRIES):
+                try:
+                    response = await client.chat.completions.create(stream=False, **request)
+                    complete_response = response.choices[0].message.content
+                    self._log_prompt_cache_usage(response)
+                    break
+                # Timeouts are connection errors too; together these are what the SDK would retry
+                except (RateLimitError, APIConnectionError, InternalServerError):
+                    if attempt == MAX_RETRIES - 1:
+                        raise
+                    await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+        self.response_cache[cache_key] = complete_response
+        return complete_response
+
+    def submit_batch(self, requests: Dict[str, Tuple[str, str, bool]], model: str) -> str:
+        """
+        Submits queries to the OpenAI Batch API, which answers within 24 hours at half the
+        price of real-time requests and with a separate rate limit.
+
+        Parameters:
+        - requests (Dict[str, Tuple[str, str, bool]]): Maps a unique custom id to the query,
+        the system prompt and the json_mode flag of one request.
+        - model (str): The identifier of the model to use for the inference.
+
+        Returns:
+        - str: The id of the created batch, to be passed to wait_for_batch.
+
+        Raises:
+        - ValueError: If the pipeline targets a local model server, which has no Batch API.
+        """
+        if self.api_endpoint is not None:
+            raise ValueError("The Batch API is only available for OpenAI models.")
+
+        batch_lines = [
+            _dumps_json(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": self._build_request(query, model, prompt, json_mode),
+                }
+            )
+            for custom_id, (query, prompt, json_mode) in requests.items()
+        ]
+        client = _get_client(self.api_endpoint)
+        batch_file = client.files.create(
+            file=("batch.jsonl", b"\n".join(batch_lines)), purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch.id} with {len(batch_lines)} requests")
+        return batch.id
+
+    def wait_for_batch(
+        self, batch_id: str, poll_interval: float = BATCH_POLL_INTERVAL
+    ) -> Dict[str, str]:
+        """
+        Waits until a batch submitted with submit_batch has finished and downloads its responses.
+
+        Parameters:
+        - batch_id (str): The id returned by submit_batch.
+        - poll_interval (float): The number of seconds between status checks. Defaults to
+        BATCH_POLL_INTERVAL.
+
+        Returns:
+        - Dict[str, str]: Maps the custom id of every successful request to the model's response.
+        Failed requests are printed and left out.
+
+        Raises:
+        - RuntimeError: If the batch fails, expires or is cancelled.
+        """
+        client = _get_client(self.api_endpoint)
+        batch = client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(poll_interval)
+            batch = client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+
+        responses = {}
+        # A batch whose requests all failed completes without an output file
+        result_file_ids = [
+            file_id for file_id in (batch.output_file_id, batch.error_file_id) if file_id
+        ]
+        for file_id in result_file_ids:
+            for line in client.files.content(file_id).content.splitlines():
+                result = _loads_json(line)
+                response = result.get("response")
+                if result.get("error") or response is None or response["status_code"] != 200:
+                    error = result.get("error") or (response or {}).get("body", {}).get("error")
+                    print(f"Request {result['custom_id']} of batch {batch_id} failed: {error}")
+                    continue
+                responses[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return responses
+
+    def get_cached_response(
+        self, query: str, model: str, prompt: str, json_mode: bool
+    ) -> Optional[str]:
+        """
+        Looks up a response in the on-disk cache.
+
+        Parameters:
+        - query (str): The query the response answers.
+        - model (str): The identifier of the model that produced the response.
+        - prompt (str): The system prompt the query was sent with.
+        - json_mode (bool): Whether JSON output was requested.
+
+        Returns:
+        - Optional[str]: The cached response, or None if there is none.
+        """
+        return self.response_cache.get(self._response_cache_key(query, model, prompt, json_mode))
+
+    def cache_response(
+        self, query: str, model: str, prompt: str, json_mode: bool, response: str
+    ) -> None:
+        """
+        Stores a response obtained outside run_inference, e.g. from the Batch API, in the on-disk
+        cache, so later runs do not pay for the same request again.
+
+        Parameters:
+        - query (str): The query the response answers.
+        - model (str): The identifier of the model that produced the response.
+        - prompt (str): The system prompt the query was sent with.
+        - json_mode (bool): Whether JSON output was requested.
+        - response (str): The response to store.
+        """
+        self.response_cache[self._response_cache_key(query, model, prompt, json_mode)] = response
+
+    def discard_cached_response(self, query: str, model: str, prompt: str, json_mode: bool) -> None:
+        """
+        Removes a response from the on-disk cache, e.g. after it turned out not to be valid JSON or
+        YAML, so the next run asks the model again instead of replaying the bad answer.
+
+        Parameters:
+        - query (str): The query the response answers.
+        - model (str): The identifier of the model that produced the response.
+        - prompt (str): The system prompt the query was sent with.
+        - json_mode (bool): Whether JSON output was requested.
+        """
+        self.response_cache.delete(self._response_cache_key(query, model, prompt, json_mode))
+
+    def _response_cache_key(self, query: str, model: str, prompt: str, json_mode: bool) -> str:
+        """
+        Helper function that hashes everything that determines a model response into a cache key.
+        """
+        return hashlib.blake2b(
+            "\0".join((self.api_endpoint or "", model, prompt, str(json_mode), query)).encode(),
+            digest_size=32,
+        ).hexdigest()
+
+    def _build_request(self, query: str, model: str, prompt: str, json_mode: bool) -> dict:
+        """
+        Helper function that builds the keyword arguments of a chat completion request.
+
+        Returns:
+        - dict: The model, temperature, response format and messages of the request.
+        """
+        if os.getenv("DEBUG_PROMPT"):
+            # Indenting costs a second parse and extra prompt tokens, so only do it when debugging
+            query = BeautifulSoup(query, "lxml").prettify()
         if json_mode :
            
             format_type = {"type": "json_object"}
@@ -296,9 +801,8 @@ class PdfToJsonPipeline:
         if not json_mode:
             # TODO is text the correct type for "normal" inference?
             format_type = {"type": "text"}
-        response_stream = client.chat.completions.create(
+        return dict(
             model=model,
-            stream=streaming,
             temperature=0.0,
             response_format=format_type,
             messages=[
@@ -306,19 +810,85 @@ class PdfToJsonPipeline:
                     "role": "system",
                     "content": prompt,
                 },
-                {"role": "user", "content": "```\n" + prettified_html + "```"},
+                {"role": "user", "content": "```\n" + query + "```"},
             ],
         )
-        if streaming:
-            complete_response = ""
-            for chunk in response_stream:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="")
-                    complete_response += chunk.choices[0].delta.content
-            return complete_response
-        else:
-            # print(response_stream.choices[0].message.content)
-            return response_stream.choices[0].message.content
+
+    def _log_prompt_cache_usage(self, response) -> None:
+        """
+        Helper function that reports how much of a request's prompt the API served from its
+        prompt cache, when the API returns that information.
+
+        Parameters:
+        - response (openai.types.chat.ChatCompletion): A non-streamed chat completion.
+        """
+        usage = response.usage
+        details = getattr(usage, "prompt_tokens_details", None) if usage is not None else None
+        if details is not None and details.cached_tokens is not None:
+            print(f"Cached prompt tokens: {details.cached_tokens} of {usage.prompt_tokens}")
+
+    def _iter_stream_deltas(self, raw_response) -> Iterator[str]:
+        """
+        Helper function that parses the server-sent events of a streamed chat completion with
+        orjson and yields the content of each delta.
+
+        Parameters:
+        - raw_response (openai.APIResponse): The unparsed response of a streaming chat completion.
+
+        Returns:
+        - Iterator[str]: The non-empty content pieces, in order.
+
+        Raises:
+        - RuntimeError: If the server reports an error in the middle of the stream.
+        """
+        for line in raw_response.iter_lines():
+            # Blank separators, comments and event names carry no data
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = _loads_json(data)
+            if "error" in chunk:
+                raise RuntimeError(f"Streamed completion failed: {chunk['error']}")
+            choices = chunk.get("choices")
+            if choices:
+                content = choices[0]["delta"].get("content")
+                if content:
+                    yield content
+
+    def _collect_stream(self, deltas: Iterable[str]) -> str:
+        """
+        Helper function that echoes a streamed completion to stdout and returns the full text.
+
+        Chunks are collected in a list and written out in batches instead of one write per token.
+
+        Parameters:
+        - deltas (Iterable[str]): The content pieces of the completion, in order.
+
+        Returns:
+        - str: The concatenated content of all chunks.
+        """
+        parts = []
+        printed = 0
+        pending_size = 0
+        last_flush = time.monotonic()
+        for content in deltas:
+            parts.append(content)
+            pending_size += len(content)
+            now = time.monotonic()
+            if (
+                pending_size >= STREAM_FLUSH_BYTES
+                or now - last_flush >= STREAM_FLUSH_SECONDS
+            ):
+                sys.stdout.write("".join(parts[printed:]))
+                sys.stdout.flush()
+                printed = len(parts)
+                pending_size = 0
+                last_flush = now
+        sys.stdout.write("".join(parts[printed:]))
+        sys.stdout.flush()
+        return "".join(parts)
 
     
     def save_response_as_json(
@@ -336,23 +906,28 @@ class PdfToJsonPipeline:
         - ValueError: If the response string is not valid JSON.
         - IOError: If there is an issue writing the file.
         """
-        cleaned_response = response.strip(
-            "```"
-        )  # More robust stripping of potential formatting characters
+        # Remove a leading ```/```json fence and a trailing ``` fence, if the model added them
+        cleaned_response = _JSON_FENCE_RE.sub("", response)
 
         try:
-            parsed_response = json.loads(
+            parsed_response = _loads_json(
                 cleaned_response
             )  # Attempt to parse the string as JSON
         except json.JSONDecodeError as e:
             raise ValueError(f"Failed to decode response as JSON: {e}")
 
+        if len(cleaned_response) > JSON_REFORMAT_MAX_CHARS:
+            # Large documents are only validated, then written as the model produced them
+            del parsed_response
+            json_bytes = cleaned_response.encode()
+        else:
+            # Write the parsed JSON back out, nicely formatted
+            json_bytes = _dumps_json(parsed_response, indent=True)
+
         output_file_path = f"{output_directory}/{output_file_name}.json"
         try:
-            with open(output_file_path, "w") as file:
-                json.dump(
-                    parsed_response, file, indent=4
-                )  # Write the parsed JSON back out, nicely formatted
+            with open(output_file_path, "wb") as file:
+                file.write(json_bytes)
         except IOError as e:
             raise IOError(f"Error writing JSON to file {output_file_path}: {e}")
         
@@ -372,18 +947,16 @@ class PdfToJsonPipeline:
         - IOError: If there is an issue writing the file.
         """
         # print(response)
-        cleaned_response = response.replace("```yaml", "")
-        cleaned_response = cleaned_response.replace("```", "")
+        cleaned_response = _YAML_FENCE_RE.sub("", response)
         print(cleaned_response)
         
         # TODO is this the correct way to clean brakets? 
-        cleaned_response = cleaned_response.replace("[", "\"")
-        cleaned_response = cleaned_response.replace("]", "\"")
+        cleaned_response = cleaned_response.translate(_BRACKETS_TO_QUOTES)
         # cleaned_response = cleaned_response.replace("\"", "")
     
         try:
             parsed_response = yaml.load(
-                cleaned_response, Loader=yaml.UnsafeLoader 
+                cleaned_response, Loader=_YamlLoader
             )  # Attempt to parse the string as YAML
         except yaml.YAMLError as e:
             raise ValueError(f"Failed to decode response as YAML: {e}")
@@ -391,7 +964,7 @@ class PdfToJsonPipeline:
         output_file_path = f"{output_directory}/{output_file_name}.yaml"
         try:
             with open(output_file_path, "w") as file:
-                yaml.dump(parsed_response, file)
+                yaml.dump(parsed_response, file, Dumper=_YamlDumper, sort_keys=False)
         except IOError as e:
             raise IOError(f"Error writing YAML to file {output_file_path}: {e}")
         
@@ -408,20 +981,19 @@ class PdfToJsonPipeline:
         Raises:
         - ValueError: If the given YAML string is not valid.
         """
-        cleaned_response = yaml_data.replace("```yaml", "")
-        cleaned_response = cleaned_response.replace("```", "")
+        cleaned_response = _YAML_FENCE_RE.sub("", yaml_data)
         try:
-            parsed_yaml = yaml.load(cleaned_response, Loader=yaml.UnsafeLoader)
+            parsed_yaml = yaml.load(cleaned_response, Loader=_YamlLoader)
         except yaml.YAMLError as e:
             raise ValueError(f"Failed to decode YAML data: {e}")
-        json_data = json.dumps(parsed_yaml, indent=4)
+        json_data = _dumps_json(parsed_yaml, indent=True)
         output_file_path = f"{output_directory}/{output_file_name}.json"
         try:
-            with open(output_file_path, "w") as file:
+            with open(output_file_path, "wb") as file:
                 file.write(json_data)
         except IOError as e:
             raise IOError(f"Error writing JSON to file {output_file_path}: {e}")
-        return json_data
+        return json_data.decode()
     
     def save_response_as_txt(
         self, response: str, output_directory: str, output_file_name: str
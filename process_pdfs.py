@@ -1,79 +1,210 @@
+import argparse
+import hashlib
 import os
 import time
-from pdf_tables_to_json_pipeline import PdfToJsonPipeline
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple
+from pdf_tables_to_json_pipeline import (
+    HTML_TO_JSON_PROMPT,
+    HTML_TO_YAML_PROMPT,
+    TEXT_TO_JSON_PROMPT,
+    TEXT_TO_YAML_PROMPT,
+    PdfToJsonPipeline,
+)
+
+# The model requests made for every PDF, in the order their responses are saved.
+RESULT_KINDS = ("html_json", "text_json", "html_yaml", "text_yaml")
+
+# Number of prepared PDFs whose model requests may be in flight at the same time.
+INFERENCE_WORKERS = 4
+
+# Number of worker processes converting and cleaning PDFs. Defaults to one per core and can be
+# lowered with the PDF_WORKERS environment variable, e.g. to leave cores free on a shared machine.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
 
 
 class ProcessPdfs:
-    def __init__(self, model_identifier: str, pdf_folder: str):
+    def __init__(
+        self,
+        model_identifier: str,
+        pdf_folder: str,
+        debug: bool = False,
+        reuse_processed: bool = False,
+        ignore_cache: bool = False,
+    ):
         self.model_identifier = model_identifier
         self.pdf_folder = pdf_folder
+        self.debug = debug
+        self.reuse_processed = reuse_processed
+        self.ignore_cache = ignore_cache
         self.pipeline = PdfToJsonPipeline(model_identifier)
 
     def process_single_pdf(self, pdf_folder_path: str, pdf_file: str) -> None:
         """
         Converts a single PDF to HTML, cleans the HTML, runs model inference, and saves the result.
+        The cleaned HTML is only written next to the results when debug or reuse_processed is
+        enabled.
+
+        Parameters:
+        - pdf_folder_path (str): The full path to the folder containing the PDF.
+        - pdf_file (str): The name of the PDF file to process.
+        """
+        self.infer_and_save(*self.prepare_pdf(pdf_folder_path, pdf_file))
+
+    def prepare_pdf(self, pdf_folder_path: str, pdf_file: str) -> Tuple[str, str, str, str]:
+        """
+        Converts a single PDF to HTML and cleans it. This is the CPU-bound half of
+        process_single_pdf. With reuse_processed, the cleaned HTML is kept next to the results
+        together with the SHA-256 of its PDF, and read back instead of converting the PDF again
+        as long as the PDF's content has not changed.
 
         Parameters:
         - pdf_folder_path (str): The full path to the folder containing the PDF.
         - pdf_file (str): The name of the PDF file to process.
+
+        Returns:
+        - Tuple[str, str, str, str]: The output directory, the base file name, the cleaned HTML
+        and its plain-text rendering.
         """
-        file_name = pdf_file.replace(".pdf", "")
+        file_name = Path(pdf_file).stem
         output_path = os.path.join(pdf_folder_path, file_name)
+        os.makedirs(output_path, exist_ok=True)
+
+        pdf_path = os.path.join(pdf_folder_path, pdf_file)
+        processed_html_path = os.path.join(output_path, f"{file_name}_processed.html")
+        source_hash_path = os.path.join(output_path, ".src.sha256")
+        pdf_hash = self._hash_file(pdf_path) if self.reuse_processed else None
+        if (
+            pdf_hash is not None
+            and os.path.isfile(processed_html_path)
+            and self._matches_stored_hash(source_hash_path, pdf_hash)
+        ):
+            with open(processed_html_path) as file:
+                # clean_html_content ends the file with a newline that is not part of the HTML
+                cleaned_html = file.read().rstrip("\n")
+        else:
+            if pdf_hash is not None and os.path.exists(source_hash_path):
+                # Until the new hash is written, a half-written cleaned HTML must not look reusable
+                os.remove(source_hash_path)
+            # Convert PDF to HTML and clean the HTML content in memory
+            html_content = self.pipeline.convert_pdf_to_html(pdf_path)
+            cleaned_html, divs = self.pipeline.clean_html_content(
+                html_content,
+                processed_html_path if self.debug or self.reuse_processed else None,
+            )
+            if pdf_hash is not None:
+                with open(source_hash_path, "w") as file:
+                    file.write(pdf_hash)
 
-        # Convert PDF to HTML and clean the HTML content
-        self.pipeline.convert_pdf_to_html(
-            os.path.join(pdf_folder_path, pdf_file), output_path
-        )
-        cleaned_html, divs = self.pipeline.clean_html_content(
-            os.path.join(output_path, f"{file_name}.html")
-        )
-        
         text_data = self.pipeline.html_to_text(cleaned_html)
-        
-        start_time = time.time()
-        # Execute model inference and save the result as JSON
-        html_tables_as_json = self.pipeline.html_tables_to_json_llm(cleaned_html, self.model_identifier, False, True)
-        # print(html_tables_as_json)
-        self.pipeline.save_response_as_json(
-        html_tables_as_json, output_path, f"{file_name}_whole"
-        )
-        self.print_running_time(start_time)
-        
-        start_time = time.time()
-        text_tables_as_json = self.pipeline.text_tables_to_json_llm(text_data,self.model_identifier, False, True)
-        # print(text_tables_as_json)
-        self.pipeline.save_response_as_json(
-            text_tables_as_json, output_path, f"{file_name}_whole_text"
-        )
-        self.print_running_time(start_time)
-        
-        start_time = time.time()
-        html_tables_as_yaml = self.pipeline.html_tables_to_yaml_llm(cleaned_html,self.model_identifier, False, False)
-        # print(html_tables_as_yaml)
-        self.pipeline.save_response_as_yaml(
-            html_tables_as_yaml, output_path, f"{file_name}_whole"
-        )
-        self.pipeline.yaml_to_json(html_tables_as_yaml,
-            output_path, f"{file_name}_whole_from_yaml"
-        )
-        self.print_running_time(start_time)
-        
+        return output_path, file_name, cleaned_html, text_data
+
+    def _hash_file(self, file_path: str) -> str:
+        """
+        Helper function that returns the SHA-256 hex digest of a file's content.
+        """
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _matches_stored_hash(self, hash_path: str, expected_hash: str) -> bool:
+        """
+        Helper function that tells whether a hash file exists and holds the expected digest.
+        """
+        try:
+            with open(hash_path) as file:
+                return file.read().strip() == expected_hash
+        except OSError:
+            return False
+
+    def inference_requests(self, cleaned_html: str, text_data: str) -> Dict[str, Tuple[str, str, bool]]:
+        """
+        Lists the model requests made for a prepared PDF.
+
+        Parameters:
+        - cleaned_html (str): The cleaned HTML of the PDF.
+        - text_data (str): The plain-text rendering of the cleaned HTML.
+
+        Returns:
+        - Dict[str, Tuple[str, str, bool]]: Maps each of RESULT_KINDS to the query, the system
+        prompt and the json_mode flag of its request.
+        """
+        return {
+            "html_json": (cleaned_html, HTML_TO_JSON_PROMPT, True),
+            "text_json": (text_data, TEXT_TO_JSON_PROMPT, True),
+            "html_yaml": (cleaned_html, HTML_TO_YAML_PROMPT, False),
+            "text_yaml": (text_data, TEXT_TO_YAML_PROMPT, False),
+        }
+
+    def infer_and_save(
+        self, output_path: str, file_name: str, cleaned_html: str, text_data: str
+    ) -> None:
+        """
+        Runs model inference on a prepared PDF and saves the results. This is the
+        network-bound half of process_single_pdf. A response that cannot be saved because it is
+        not valid JSON or YAML is removed from the response cache before the error is raised.
+
+        Parameters:
+        - output_path (str): The directory where the results are saved.
+        - file_name (str): The base name for the result files.
+        - cleaned_html (str): The cleaned HTML of the PDF.
+        - text_data (str): The plain-text rendering of the cleaned HTML.
+
+        Raises:
+        - ValueError: If a response is not valid JSON or YAML.
+        """
         start_time = time.time()
-        text_tables_as_yaml = self.pipeline.text_tables_to_yaml_llm(text_data, self.model_identifier, False, False)
-        # print(text_tables_as_yaml)
-        self.pipeline.save_response_as_yaml(
-            text_tables_as_yaml, output_path, f"{file_name}_whole_text"
-        )
-        self.pipeline.yaml_to_json(text_tables_as_yaml,
-            output_path, f"{file_name}_whole_text_from_yaml"
-        )
+        requests = self.inference_requests(cleaned_html, text_data)
+        # The four inference calls are independent and network-bound, so run them concurrently
+        with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+            futures = {
+                kind: executor.submit(
+                    self.pipeline.run_inference,
+                    query,
+                    self.model_identifier,
+                    False,
+                    prompt,
+                    json_mode,
+                    self.ignore_cache,
+                )
+                for kind, (query, prompt, json_mode) in requests.items()
+            }
+
+        for kind, future in futures.items():
+            try:
+                self.save_result(output_path, file_name, kind, future.result())
+            except ValueError:
+                query, prompt, json_mode = requests[kind]
+                self.pipeline.discard_cached_response(
+                    query, self.model_identifier, prompt, json_mode
+                )
+                raise
         self.print_running_time(start_time)
-        
-        # self.pipeline.save_response_as_txt(
-        #     html_tables_as_yaml, output_path, f"{file_name}_whole"
-        # )
-      
-        
+
+    def save_result(self, output_path: str, file_name: str, kind: str, response: str) -> None:
+        """
+        Saves one model response for a PDF. JSON responses are saved as JSON, YAML responses as
+        YAML and as the JSON converted from it.
+
+        Parameters:
+        - output_path (str): The directory where the results are saved.
+        - file_name (str): The base name for the result files.
+        - kind (str): Which of RESULT_KINDS the response answers.
+        - response (str): The model response.
+
+        Raises:
+        - ValueError: If the response is not valid JSON or YAML.
+        """
+        base_name = f"{file_name}_whole" if kind.startswith("html") else f"{file_name}_whole_text"
+        if kind.endswith("json"):
+            self.pipeline.save_response_as_json(response, output_path, base_name)
+        else:
+            self.pipeline.save_response_as_yaml(response, output_path, base_name)
+            self.pipeline.yaml_to_json(response, output_path, f"{base_name}_from_yaml")
 
     def print_running_time(self, start_time: float) -> None:
         """
@@ -86,6 +217,21 @@ class ProcessPdfs:
         running_time = end_time - start_time
         print(f"Running time: {running_time:.2f} seconds")
 
+    def list_pdf_files(self, pdf_folder_path: str) -> List[str]:
+        """
+        Lists the names of the PDF files in a folder.
+
+        Parameters:
+        - pdf_folder_path (str): The full path to the folder containing the PDFs.
+
+        Returns:
+        - List[str]: The names of the PDF files.
+        """
+        with os.scandir(pdf_folder_path) as entries:
+            return [
+                entry.name for entry in entries if entry.is_file() and entry.name.endswith(".pdf")
+            ]
+
     def run(self):
         """
         Processes all PDF files in a given folder: converting them to HTML, cleaning the HTML content,
@@ -95,19 +241,128 @@ class ProcessPdfs:
 
         # Resolve the full path to the PDF folder and gather all PDF files
         pdf_folder_path = os.path.join(os.getcwd(), self.pdf_folder)
-        pdf_files = [f for f in os.listdir(pdf_folder_path) if f.endswith(".pdf")]
+        pdf_files = self.list_pdf_files(pdf_folder_path)
 
-        for pdf_file in pdf_files:
-            self.process_single_pdf(pdf_folder_path, pdf_file)
+        # Conversion and cleaning run in up to PDF_WORKERS worker processes. As soon as a PDF is
+        # prepared its inference is handed to a thread, so later PDFs keep converting while
+        # earlier ones wait on the model.
+        max_workers = max(1, min(PDF_WORKERS, len(pdf_files)))
+        with ProcessPoolExecutor(max_workers=max_workers) as prepare_executor, ThreadPoolExecutor(
+            max_workers=INFERENCE_WORKERS
+        ) as inference_executor:
+            prepared = [
+                prepare_executor.submit(self.prepare_pdf, pdf_folder_path, pdf_file)
+                for pdf_file in pdf_files
+            ]
+            inferred = [
+                inference_executor.submit(self.infer_and_save, *future.result())
+                for future in as_completed(prepared)
+            ]
+            for future in inferred:
+                future.result()
+
+        self.print_running_time(start_time)
+
+    def run_batch(self):
+        """
+        Processes all PDF files in a given folder like run, but sends every model request of every
+        PDF in one submission to the OpenAI Batch API. This is slower to finish but costs half as
+        much, which suits offline processing of large folders. Requests found in the response
+        cache are not submitted, and responses that could be saved are added to the cache.
+        """
+        start_time = time.time()
+
+        pdf_folder_path = os.path.join(os.getcwd(), self.pdf_folder)
+        pdf_files = self.list_pdf_files(pdf_folder_path)
+        if not pdf_files:
+            print(f"No PDF files found in {pdf_folder_path}")
+            return
+
+        max_workers = max(1, min(PDF_WORKERS, len(pdf_files)))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            prepared_pdfs = list(
+                executor.map(partial(self.prepare_pdf, pdf_folder_path), pdf_files)
+            )
+
+        requests = {}
+        for index, (_, _, cleaned_html, text_data) in enumerate(prepared_pdfs):
+            for kind, request in self.inference_requests(cleaned_html, text_data).items():
+                requests[f"pdf{index}_{kind}"] = request
+
+        # Requests answered in an earlier run, batched or not, are not paid for again
+        responses = {}
+        if not self.ignore_cache:
+            for custom_id, (query, prompt, json_mode) in requests.items():
+                cached_response = self.pipeline.get_cached_response(
+                    query, self.model_identifier, prompt, json_mode
+                )
+                if cached_response is not None:
+                    responses[custom_id] = cached_response
+        pending_requests = {
+            custom_id: request
+            for custom_id, request in requests.items()
+            if custom_id not in responses
+        }
+        if pending_requests:
+            batch_id = self.pipeline.submit_batch(pending_requests, self.model_identifier)
+            responses.update(self.pipeline.wait_for_batch(batch_id))
+
+        # Every response is saved on its own, so one bad answer does not cost the others
+        for index, (output_path, file_name, _, _) in enumerate(prepared_pdfs):
+            for kind in RESULT_KINDS:
+                custom_id = f"pdf{index}_{kind}"
+                if custom_id not in responses:
+                    print(f"Skipping {kind} of {file_name}: its batch request failed")
+                    continue
+                query, prompt, json_mode = requests[custom_id]
+                try:
+                    self.save_result(output_path, file_name, kind, responses[custom_id])
+                except ValueError as e:
+                    print(f"Skipping {kind} of {file_name}: {e}")
+                    self.pipeline.discard_cached_response(
+                        query, self.model_identifier, prompt, json_mode
+                    )
+                    continue
+                self.pipeline.cache_response(
+                    query, self.model_identifier, prompt, json_mode, responses[custom_id]
+                )
 
         self.print_running_time(start_time)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Extract the tables of PDF files as JSON and YAML.")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Send all requests through the OpenAI Batch API: half the cost, results within 24 hours.",
+    )
+    parser.add_argument(
+        "--reuse-processed",
+        action="store_true",
+        help="Keep the cleaned HTML of every PDF and reuse it on later runs instead of converting "
+        "the PDF again, unless the PDF's content has changed.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ask the model again instead of reusing cached responses. Fresh responses still "
+        "replace the cached ones.",
+    )
+    args = parser.parse_args()
+
     model_identifier = "gpt-3.5-turbo"
     pdf_folder = "test"
-    process_pdfs = ProcessPdfs(model_identifier, pdf_folder)
-    process_pdfs.run()
+    process_pdfs = ProcessPdfs(
+        model_identifier,
+        pdf_folder,
+        reuse_processed=args.reuse_processed,
+        ignore_cache=args.no_cache,
+    )
+    if args.batch:
+        process_pdfs.run_batch()
+    else:
+        process_pdfs.run()
 
 
 if __name__ == "__main__":